@@ -10,11 +10,11 @@ else:
 
 
 def main():
-	# load and build config
+	# load and build config, only once for every deployment
 	config = Config()
 	# get the deployment list from the given arguments
 	to_deploy = config.get_arguments()
 	# create the worker
-	deploy = Deploy(to_deploy)
+	deploy = Deploy(to_deploy, config.jobs)
 	# deploy the list
 	deploy.deploy_all()
\ No newline at end of file
@@ -1,11 +1,64 @@
+import os
+import re
+import shlex
+import shutil
 import subprocess
 from rich import print
 
 class Cmd:
-	def execute(self, cmd):
+	# characters that only a shell can interpret, = covers leading variable assignments
+	SHELL_CHARS = re.compile(r"[|&;<>()$`\\*?\[\]{}~\n=#!]")
+
+	def run(self, cmd):
+		"""
+		Executes a local command and prints its output line by line as it comes,
+		so long running hooks never buffer their whole output
+
+		Parameters:
+			cmd (str|list): the command to execute, a list is run as is
+
+		Returns:
+			bool: True when the command succeeded
+		"""
 		try:
-			result = subprocess.check_output(cmd, shell=True).decode("utf-8")
-			return result
+			with subprocess.Popen(self._build(cmd), shell=self._needs_shell(cmd), stdout=subprocess.PIPE, text=True) as proc:
+				for line in proc.stdout:
+					print(f"[bold cyan][CMD][/bold cyan] : {line.rstrip()}")
+			if proc.returncode:
+				raise subprocess.CalledProcessError(proc.returncode, cmd)
+			return True
 		except Exception as e:
 			print("[bold cyan][CMD][/bold cyan] [bold red]Error while executing command[/bold red] :", e)
-			return ""
\ No newline at end of file
+			return False
+
+	def run_all(self, cmds):
+		"""
+		Executes several commands one by one, each failure is reported and
+		stops the ones after it
+
+		Returns:
+			bool: True when every command succeeded
+		"""
+		return all(self.run(c) for c in cmds)
+
+	def _needs_shell(self, cmd):
+		"""
+		Only strings using shell syntax, or whose command is not an executable
+		on the PATH (builtins, functions...), go through a shell. Windows always
+		needs one to resolve builtins and .cmd scripts
+		"""
+		if not isinstance(cmd, str):
+			return False
+		if os.name == "nt" or self.SHELL_CHARS.search(cmd):
+			return True
+		try:
+			words = shlex.split(cmd)
+		except ValueError:
+			# unbalanced quotes, let the shell report it
+			return True
+		return not words or shutil.which(words[0]) is None
+
+	def _build(self, cmd):
+		if not isinstance(cmd, str) or self._needs_shell(cmd):
+			return cmd
+		return shlex.split(cmd)
@@ -1,98 +1,128 @@
+import os
 import sys
 import json
-from argparse import ArgumentParser
-from jsonschema import validate, ValidationError
+import mmap
+from jsonschema import Draft7Validator
 from rich import print
 
+# orjson is optional, it parses bytes directly and is several times faster
+try:
+	import orjson as _json
+except ImportError:
+	_json = json
+
+# local commands are a shell string or an argv list, run without any shell
+LOCAL_CMD = { "type": ["string", "array"], "items": { "type": "string" }, "minItems": 1 }
+
+# built once at import time, together with its validator
+SCHEMA = {"type": "object",
+	"properties": {
+		"hosts" : {
+			"type": "array",
+			"minItems" : 1,
+			"items": {
+				"type": "object",
+				"properties": {
+					"name" : { "type": "string" },
+					"hostname" : { "type": "string" },
+					"username" : { "type": "string" },
+					"password" : { "type": "string" },
+					"port" : { "type": "integer" },
+					"ftp" : { 
+						"type": "object",
+						"properties": {
+							"hostname": { "type": "string" },
+							"username": { "type": "string" },
+							"password": { "type": "string" },
+							"port": { "type": "integer" },
+							"connections": { "type": "integer", "minimum": 1, "maximum": 8 },
+						},
+						"required": ["username", "password"],
+						"additionalProperties" : False
+					 },
+					"sftp" : { 
+						"type": "object",
+						"properties": {
+							"hostname": { "type": "string" },
+							"username": { "type": "string" },
+							"password": { "type": "string" },
+							"port": { "type": "integer" },
+							"connections": { "type": "integer", "minimum": 1, "maximum": 8 },
+						},
+						"required": ["username", "password"],
+						"additionalProperties" : False
+					 },
+					"ssh" : { 
+						"type": "object",
+						"properties": {
+							"hostname": { "type": "string" },
+							"username": { "type": "string" },
+							"password": { "type": "string" },
+							"port": { "type": "integer" },
+						},
+						"required": ["username", "password"],
+						"additionalProperties" : False
+					 },
+
+				},
+				"required": ["name", "hostname"],
+				"additionalProperties" : False
+			}
+		},
+		"deployments": {
+			"type": "array",
+			"minItems" : 1,
+			"items": {
+				"type": "object",
+				"properties": {
+					"name" : { "type": "string" },
+					"host" : { "type": "string" },
+					"arg" : { "type": "string", "pattern": "^-.*$" },
+					"protocol" : { "type": "string" , "enum": ["ftp", "sftp"] },
+
+					"local_path" : { "type": "string" },
+					"remote_path" : { "type": "string" },
+
+					"exclude" : { "type": "array" },
+					"stage" : { "type": "boolean" },
+					"incremental" : { "type": "boolean" },
+					"stream" : { "type": "boolean" },
+
+					"cmd" : {
+						"type": "object",
+						"properties": {
+							"before" : LOCAL_CMD,
+							"after" : LOCAL_CMD,
+
+							"cmd" : LOCAL_CMD,
+
+							"ssh" : { "type": "string" },
+							"ssh_before" : { "type": "string" },
+							"ssh_after" : { "type": "string" },
+						},
+						"additionalProperties" : False
+					}
+					
+				},
+				"required": ["name", "host", "arg", "protocol"],
+				"additionalProperties" : False
+			}
+		}
+	},
+	"required": ["hosts", "deployments"],
+	"additionalProperties" : False}
+
+_VALIDATOR = Draft7Validator(SCHEMA)
+
 class Config:
 	CONFIG_FILE = "deploy.config.json"
+	DEFAULT_PORTS = {"ssh": 22, "sftp": 22, "ftp": 21}
+	# below this size a plain read is as fast as mapping the file
+	MMAP_THRESHOLD = 1 << 20
 	config = {}
-	schema = {"type": "object",
-		"properties": {
-			"hosts" : {
-				"type": "array",
-				"minItems" : 1,
-				"items": {
-					"type": "object",
-					"properties": {
-						"name" : { "type": "string" },
-						"hostname" : { "type": "string" },
-						"username" : { "type": "string" },
-						"password" : { "type": "string" },
-						"ftp" : { 
-							"type": "object",
-							"properties": {
-								"username": { "type": "string" },
-								"password": { "type": "string" },
-								"port": { "type": "integer" },
-							},
-							"required": ["username", "password"],
-							"additionalProperties" : False
-						 },
-						"sftp" : { 
-							"type": "object",
-							"properties": {
-								"username": { "type": "string" },
-								"password": { "type": "string" },
-								"port": { "type": "integer" },
-							},
-							"required": ["username", "password"],
-							"additionalProperties" : False
-						 },
-						"ssh" : { 
-							"type": "object",
-							"properties": {
-								"username": { "type": "string" },
-								"password": { "type": "string" },
-								"port": { "type": "integer" },
-							},
-							"required": ["username", "password"],
-							"additionalProperties" : False
-						 },
-
-					},
-					"required": ["name", "hostname"],
-					"additionalProperties" : False
-				}
-			},
-			"deployments": {
-				"type": "array",
-				"minItems" : 1,
-				"items": {
-					"type": "object",
-					"properties": {
-						"name" : { "type": "string" },
-						"host" : { "type": "string" },
-						"arg" : { "type": "string", "pattern": "^-.*$" },
-						"protocol" : { "type": "string" , "enum": ["ftp", "sftp"] },
-
-						"local_path" : { "type": "string" },
-						"remote_path" : { "type": "string" },
-
-						"exclude" : { "type": "array" },
-
-						"cmd" : {
-							"type": "object",
-							"properties": {
-								"before" : { "type": "string" },
-								"after" : { "type": "string" },
-
-								"cmd" : { "type": "string" },
-
-								"ssh_before" : { "type": "string" },
-								"ssh_after" : { "type": "string" },
-							},
-							"additionalProperties" : False
-						}
-						
-					},
-					"required": ["name", "host", "arg", "protocol"],
-					"additionalProperties" : False
-				}
-			}
-		},
-		"required": ["hosts", "deployments"],
-		"additionalProperties" : False}
+	_arguments = None
+	jobs = 1
+	schema = SCHEMA
 	
 	def __init__(self):
 		self._load_config()
@@ -105,8 +135,13 @@ class Config:
 		Loads and set the config file
 		"""
 		try:
-			with open(self.CONFIG_FILE, "r") as f:
-				self.config = json.loads(f.read())
+			with open(self.CONFIG_FILE, "rb") as f:
+				# orjson can parse large generated configs straight from the mapped pages
+				if _json is not json and os.fstat(f.fileno()).st_size >= self.MMAP_THRESHOLD:
+					with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm, memoryview(mm) as view:
+						self.config = _json.loads(view)
+				else:
+					self.config = _json.loads(f.read())
 		except FileNotFoundError:
 			print(f"{self.CONFIG_FILE} [bold red]not found[/bold red]")
 			sys.exit(1)
@@ -115,10 +150,12 @@ class Config:
 			sys.exit(1)
 	
 	def _validate(self):
-		try:
-			validate(instance=self.config, schema=self.schema)
-		except ValidationError as e:
-			print(f"{self.CONFIG_FILE} [bold red]is invalid[/bold red] : {e}")
+		"""
+		Validates the config against the precompiled schema validator
+		"""
+		errors = sorted(_VALIDATOR.iter_errors(self.config), key=lambda e: [str(p) for p in e.path])
+		if errors:
+			print(f"{self.CONFIG_FILE} [bold red]is invalid[/bold red] : {errors[0]}")
 			sys.exit(1)
 
 	def _build_hosts_dict(self):
@@ -135,31 +172,37 @@ class Config:
 		self.config["hosts"] = hosts
 
 	def _build_host_protocols_dict(self, host, protocol):
+		"""
+		Resolves the connection settings of a protocol, falling back on the host ones
+		"""
 		protocol_dict = host.get(protocol) or {}
-		ssh_port, sftp_port, ftp_port,  = 22, 22, 21
-		port = protocol_dict.get("port") or host.get("port") or ssh_port if protocol == "ssh" else sftp_port if protocol == "sftp" else ftp_port
-		return {
+		# the host port is the ssh server's one, shared by ssh and sftp, ftp listens elsewhere
+		host_port = host.get("port") if protocol != "ftp" else None
+		port = protocol_dict.get("port") or host_port or self.DEFAULT_PORTS[protocol]
+		protocol_config = {
 			"hostname": protocol_dict.get("hostname") or host.get("hostname"),
 			"username": protocol_dict.get("username") or host.get("username"),
 			"password": protocol_dict.get("password") or host.get("password"),
 			"port":  port
 		}
+		if protocol in ("ftp", "sftp"):
+			protocol_config["connections"] = protocol_dict.get("connections")
+		return protocol_config
 
 	def _build_deployments_dict(self):
 		"""
 		Builds a deployment dictionary from the config file
 		"""
 
-		deployments = {}
 		hosts = self.config["hosts"]
-		for d in self.config["deployments"]:
-			if d["host"] not in hosts:
-				print(f"[bold red]Host[/bold red]: {d['host']} [bold red]not found in hosts list[/bold red]")
-				sys.exit(1)
-			d["host"] = hosts[d["host"]]
-			deployments[d["arg"]] = d
-		
-		self.config["deployments"] = deployments
+		deployments = self.config["deployments"]
+		missing = {d["host"] for d in deployments} - hosts.keys()
+		if missing:
+			print(f"[bold red]Host[/bold red]: {', '.join(sorted(missing))} [bold red]not found in hosts list[/bold red]")
+			sys.exit(1)
+
+		# fresh dicts, the loaded deployments are left untouched
+		self.config["deployments"] = {d["arg"]: {**d, "host": hosts[d["host"]]} for d in deployments}
 
 	def get_arguments(self):
 		"""
@@ -168,13 +211,73 @@ class Config:
 		Returns:
 			list: A list of deployment to execute
 		"""
+		if self._arguments is not None:
+			return self._arguments
+
 		deployments = self.config.get("deployments")
+		argv = set(self._pop_jobs(sys.argv[1:]))
+		flags = self._build_flags(deployments)
+
+		# argparse is only needed for the help, abbreviations and unknown arguments
+		if argv.issubset(flags):
+			requested = {flags[a] for a in argv}
+		else:
+			parsed = vars(self._build_parser(deployments, flags).parse_args())
+			self.jobs = parsed.pop("jobs")
+			requested = {a for a, y in parsed.items() if y}
+
+		# only return the requested deployments, in the config order
+		self._arguments = [d for arg, d in deployments.items() if arg in requested]
+		return self._arguments
+
+	def _pop_jobs(self, argv):
+		"""
+		Extracts the --jobs option from the arguments and sets self.jobs
+
+		Returns:
+			list: the remaining arguments
+		"""
+		remaining = []
+		i = 0
+		while i < len(argv):
+			a = argv[i]
+			if a == "--jobs" and i + 1 < len(argv) and argv[i + 1].isdigit():
+				self.jobs = int(argv[i + 1])
+				i += 2
+				continue
+			if a.startswith("--jobs=") and a[7:].isdigit():
+				self.jobs = int(a[7:])
+			else:
+				# malformed values are left to argparse to report
+				remaining.append(a)
+			i += 1
+		return remaining
+
+	def _build_flags(self, deployments):
+		"""
+		Builds the lookup table of every accepted flag, the deployment arg itself
+		(-fb), its historical long form (---fb) and a regular long form (--fb)
+
+		Returns:
+			dict: the deployment arg of every flag
+		"""
+		# the args themselves win over the aliases of other deployments
+		flags = {arg: arg for arg in deployments}
+		for arg in deployments:
+			for alias in (f"--{arg}", "--" + arg.lstrip("-")):
+				if alias != "--jobs":
+					flags.setdefault(alias, arg)
+		return flags
+
+	def _build_parser(self, deployments, flags):
+		"""
+		Builds the argument parser, one flag per deployment
+		"""
+		from argparse import ArgumentParser
 		parser = ArgumentParser()
+		parser.add_argument("--jobs", type=int, default=self.jobs, help="Number of hosts to deploy at the same time")
 		for d in deployments:
 			name = deployments[d]["name"]
-			arg = deployments[d]["arg"]
-			parser.add_argument(arg, f"--{arg}", help=f"Execute the deployment {name}", action="store_true")
-		
-		# only return the deployments that are set to true
-		arguments = [deployments["-"+x] for x,y in vars(parser.parse_args()).items() if y]
-		return arguments
\ No newline at end of file
+			names = [f for f, arg in flags.items() if arg == d]
+			parser.add_argument(*names, dest=d, help=f"Execute the deployment {name}", action="store_true")
+		return parser
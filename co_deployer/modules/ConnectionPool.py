@@ -0,0 +1,58 @@
+import threading
+
+if __package__ is None or __package__ == '':
+	# uses current directory visibility
+	from modules.Ftp import Ftp
+	from modules.Ssh import Ssh
+	from modules.Sftp import Sftp
+else:
+	# uses current package visibility
+	from .Ftp import Ftp
+	from .Ssh import Ssh
+	from .Sftp import Sftp
+
+class ConnectionPool:
+	"""
+	Opens the connections lazily and keeps them for the whole run. They are keyed
+	by protocol, server and account, so hosts pointing to the same server share
+	them, even when they are deployed from different threads.
+	"""
+
+	def __init__(self):
+		self._connections = {}
+		self._locks = {}
+		self._lock = threading.Lock()
+
+	def get(self, host, protocol):
+		"""
+		Returns the connection to the host server for the protocol, opening it on first use
+		"""
+		config = host.get(protocol)
+		key = (protocol, config["hostname"], config["port"], config["username"])
+		# one lock per key, connecting to a server never waits on another one
+		with self._lock:
+			key_lock = self._locks.setdefault(key, threading.Lock())
+		with key_lock:
+			if key not in self._connections:
+				self._connections[key] = self._open(key, config)
+			return self._connections[key]
+
+	def close_all(self):
+		"""
+		Disconnects every connection of the pool
+		"""
+		with self._lock:
+			connections = list(self._connections.values())
+			self._connections = {}
+		for client in connections:
+			client.disconnect()
+
+	def _open(self, key, config):
+		protocol = key[0]
+		if protocol == "sftp":
+			return Sftp(config)
+		if protocol == "ftp":
+			return Ftp(config)
+		# an sftp transport logged in on the same account is reused, saving a handshake
+		sftp = self._connections.get(("sftp",) + key[1:])
+		return Ssh(config, sftp.transport if sftp else None)
@@ -1,150 +1,215 @@
 import os
 import sys
 import shutil
+import fnmatch
+import re
 import tempfile
-import uuid
+from concurrent.futures import ThreadPoolExecutor
 from rich import print
 
 if __package__ is None or __package__ == '':
 	# uses current directory visibility
-	import modules.Ftp
-	import modules.Ssh
-	import modules.Sftp
 	import modules.Cmd
+	from modules.ConnectionPool import ConnectionPool
 else:
 	# uses current package visibility
-	from .Ftp import Ftp
-	from .Ssh import Ssh
-	from .Sftp import Sftp
 	from .Cmd import Cmd
+	from .ConnectionPool import ConnectionPool
+
+# ioctl request cloning a whole file on copy-on-write filesystems (btrfs, xfs)
+FICLONE = 0x40049409
+
+# set once a clone failed, the sources and the staging folder can not share
+# extents (other filesystem, no reflink support), the next files are copied directly
+_clone_failed = False
+
+def _clone(src, dst):
+	"""
+	copytree copy function staging a file as cheaply as the filesystem allows,
+	a copy-on-write clone when possible and a regular copy otherwise. Both give
+	an independent file, the hooks can rewrite the sources without touching it
+	"""
+	global _clone_failed
+	if not _clone_failed:
+		try:
+			import fcntl
+			with open(src, "rb") as s, open(dst, "wb") as d:
+				fcntl.ioctl(d.fileno(), FICLONE, s.fileno())
+			shutil.copystat(src, dst)
+			return dst
+		except (ImportError, OSError):
+			_clone_failed = True
+	return shutil.copy2(src, dst)
 
 class Deploy:
 	deployments = None
-	ftp = None
-	sftp = None
-	ssh = None
 	cmd = None
+	jobs = None
 
-	def __init__(self, deployments):
+	def __init__(self, deployments, jobs=1):
 		self.deployments = deployments
-		self.cmd = Cmd()	
-	def __del__(self):
-		self._close_connections()
-		
+		self.jobs = max(1, jobs)
+		self.cmd = Cmd()
+
 	def deploy_all(self):
-		for d in self.deployments:
-			self._deploy(d)
-	
-		self._close_connections()
-		
-	def _deploy(self, deployment):
-		# deployment variables
-		name = deployment.get("name")
-		protocol = deployment.get("protocol")
-		local_path = deployment.get("local_path", ".")
-		remote_path = deployment.get("remote_path", "/")
-		exclude = deployment.get("exclude", [])
-		cmd = deployment.get("cmd", "") or {}
-		cmd_shell = cmd.get("cmd")
-		cmd_ssh = cmd.get("ssh")
-		cmd_before = cmd.get("before")
-		cmd_after = cmd.get("after")
-		cmd_ssh_before = cmd.get("ssh_before")
-		cmd_ssh_after = cmd.get("ssh_after")
+		"""
+		Runs the deployments host by host, up to jobs hosts at the same time
+		"""
+		groups = self._group_by_host(self.deployments)
+		# one pool for the whole run, hosts pointing to the same server share their connections
+		pool = ConnectionPool()
+		try:
+			if self.jobs == 1 or len(groups) < 2:
+				for g in groups:
+					self._deploy_host(g, pool)
+			else:
+				with ThreadPoolExecutor(max_workers=min(self.jobs, len(groups))) as ex:
+					list(ex.map(lambda g: self._deploy_host(g, pool), groups))
+		finally:
+			pool.close_all()
 
-		# host variables
-		host = deployment.get("host")
-		ftp = host.get("ftp")
-		sftp = host.get("sftp")
-		ssh = host.get("ssh")
+	def _group_by_host(self, deployments):
+		"""
+		Groups the deployments by host, keeping the order of first appearance
 
-		# create temporary directory
-		tmp_dir = self._create_tmp_directory(local_path, exclude)
+		Returns:
+			list: a list of deployment lists
+		"""
+		groups = {}
+		for d in deployments:
+			groups.setdefault(d["host"]["name"], []).append(d)
+		return list(groups.values())
 
-		# reset connections
-		self._close_connections()
+	def _deploy_host(self, deployments, pool):
+		"""
+		Runs the deployments of one host: the local cmd and before hooks of all of
+		them first, then their ssh commands batched in one channel, the uploads,
+		and the ssh after commands batched in one channel after the last upload.
+		When a local hook fails nothing is run on the server
+		"""
+		host = deployments[0]["host"]
+		pre_ssh_cmds = [c for d in deployments for c in self._get_cmds(d, "ssh", "ssh_before")]
+		post_ssh_cmds = [c for d in deployments for c in self._get_cmds(d, "ssh_after")]
 
-		# create connections	
-		if cmd_ssh or cmd_ssh_before or cmd_ssh_after:
-			self.ssh = Ssh(ssh)
-		
-		if protocol == "sftp":
-			self.sftp = Sftp(sftp)
+		# the snapshots are taken before the hooks run so they can not change what gets uploaded
+		sources = [self._prepare(d) for d in deployments]
+		try:
+			if not all(self.cmd.run_all(self._get_cmds(d, "cmd", "before")) for d in deployments):
+				print(f"[bold red]Local command failed[/bold red], host {host['name']} is not deployed")
+				return
 
-		if protocol == "ftp":
-			self.ftp = Ftp(ftp)
-		
-		# execute base commands
-		if cmd_shell:
-			result = self.cmd.execute(cmd_shell)
-			print(f"[bold cyan][CMD][/bold cyan] : {result}")
-		
-		if cmd_ssh:
-			result = self.ssh.execute(cmd_ssh)
-			print(f"[bold cyan][SSH][/bold cyan] : {result}")
+			# open sftp first so the ssh commands can share its transport, streamed
+			# deployments only need an ssh channel, their sftp pool opens on fallback
+			if any(d["protocol"] == "sftp" and not d.get("stream") for d in deployments):
+				pool.get(host, "sftp")
 
-		# execute the commands before the deployment
-		if cmd_before:
-			result = self.cmd.execute(cmd_before)
-			print(f"[bold cyan][CMD][/bold cyan] : {result}")
+			if pre_ssh_cmds:
+				result = pool.get(host, "ssh").exec_batch(pre_ssh_cmds)
+				print(f"[bold cyan][SSH][/bold cyan] : {result}")
 
-		if cmd_ssh_before:
-			result = self.ssh.execute(cmd_ssh_before)
-			print(f"[bold cyan][SSH][/bold cyan] : {result}")
+			for d, (upload_dir, ignore) in zip(deployments, sources):
+				self._deploy(d, pool, upload_dir, ignore)
+
+			if post_ssh_cmds:
+				result = pool.get(host, "ssh").exec_batch(post_ssh_cmds)
+				print(f"[bold cyan][SSH][/bold cyan] : {result}")
+		finally:
+			for d, (upload_dir, _) in zip(deployments, sources):
+				if d.get("stage", False):
+					self._delete_tmp_directory(upload_dir)
+
+	def _get_cmds(self, deployment, *keys):
+		cmd = deployment.get("cmd", "") or {}
+		return [cmd[k] for k in keys if cmd.get(k)]
+
+	def _prepare(self, deployment):
+		"""
+		Returns: the folder to upload and its ignore callable. Files are read straight
+		from local_path, unless a snapshot is asked for with stage
+		"""
+		local_path = deployment.get("local_path", ".")
+		exclude = deployment.get("exclude", [])
+		if deployment.get("stage", False):
+			return self._create_tmp_directory(local_path, exclude), None
+		return local_path, self._build_ignore(local_path, exclude)
+
+	def _deploy(self, deployment, pool, upload_dir, ignore):
+		# deployment variables
+		protocol = deployment.get("protocol")
+		remote_path = deployment.get("remote_path", "/")
+		incremental = deployment.get("incremental", False)
+		stream = deployment.get("stream", False)
+		cmd_after = (deployment.get("cmd", "") or {}).get("after")
+
+		# host variables
+		host = deployment.get("host")
 
 		# deploy
 		if protocol == "sftp":
-			print("[bold cyan][SFTP][/bold cyan] Deploying[FTP]...")
-			self.sftp.upload(tmp_dir, remote_path)
+			print("[bold cyan][SFTP][/bold cyan] Deploying...")
+			# a single tar stream over ssh, the per file upload is kept as the fallback
+			if not (stream and pool.get(host, "ssh").upload_tar(upload_dir, remote_path, ignore)):
+				pool.get(host, "sftp").upload(upload_dir, remote_path, ignore, incremental)
 			print("[bold cyan][SFTP][/bold cyan] [bold green]Successfully[/bold green] deployed")
 		
 		if protocol == "ftp":
 			print("[bold cyan][FTP][/bold cyan] Deploying...")
-			self.ftp.upload(tmp_dir, remote_path)
+			pool.get(host, "ftp").upload(upload_dir, remote_path, ignore, incremental)
 			print("[bold cyan][FTP][/bold cyan] [bold green]Successfully[/bold green] deployed")
 		
 		# execute the commands after the deployment
 		if cmd_after:
-			result = self.cmd.execute(cmd_after)
-			print(f"[bold cyan][CMD][/bold cyan] : {result}")
-
-		if cmd_ssh_after:
-			result = self.cmd.execute(cmd_ssh_after)
-			print(f"[bold cyan][SSH][/bold cyan] : {result}")
-	
-		# delete the remote directory
-		self._delete_tmp_directory(tmp_dir)
+			self.cmd.run(cmd_after)
 	
 	def _create_tmp_directory(self, local_path, exclude):
-		# create a temporary directory
-		tmp_dir = os.path.join(tempfile.gettempdir(), str(uuid.uuid4()))
-		
-		# copy the local directory to the temporary directory and exclude files
+		# copy the local directory to a fresh temporary directory, excluded files are never copied
 		try:
-			shutil.copytree(local_path, tmp_dir)
-			for item in exclude:
-				item_path = os.path.join(tmp_dir, item)
-				if os.path.isfile(item_path):
-					os.remove(item_path)
-				elif os.path.isdir(item_path):
-					shutil.rmtree(item_path)			
+			tmp_dir = tempfile.mkdtemp(prefix="codep-")
+			shutil.copytree(local_path, tmp_dir, ignore=self._build_ignore(local_path, exclude), copy_function=_clone, dirs_exist_ok=True)
 		except Exception as e:
 			print(f"[bold red]Error[/bold red] creating temporary directory: {e}")
 			sys.exit(1)
 		
 		return tmp_dir
+
+	def _build_ignore(self, local_path, exclude):
+		"""
+		Builds an ignore callable from the exclude list, shared by copytree and the uploaders
+
+		Patterns containing a separator are matched against the path relative
+		to local_path, the others against the file or folder name at any depth.
+		"""
+		patterns = [os.path.normpath(e) for e in exclude]
+		name_re = self._compile_patterns(p for p in patterns if os.sep not in p)
+		path_re = self._compile_patterns(p for p in patterns if os.sep in p)
+
+		def ignore(directory, names):
+			rel_dir = os.path.relpath(directory, local_path)
+			ignored = []
+			for name in names:
+				if (name_re and name_re.match(name)) or (path_re and path_re.match(os.path.normpath(os.path.join(rel_dir, name)))):
+					ignored.append(name)
+			return ignored
+
+		return ignore
 	
+	def _compile_patterns(self, patterns):
+		"""
+		Compiles glob patterns into a single regex, matching any of them
+
+		Returns:
+			re.Pattern: the regex, None when there is no pattern
+		"""
+		patterns = [fnmatch.translate(p) for p in patterns]
+		if not patterns:
+			return None
+		# same case rule as fnmatch.fnmatch, which relies on os.path.normcase
+		flags = re.IGNORECASE if os.path.normcase("A") == "a" else 0
+		return re.compile("|".join(patterns), flags)
+
 	def _delete_tmp_directory(self, tmp_dir):
 		try:
 			shutil.rmtree(tmp_dir)
 		except Exception as e:
 			print(f"[bold red]Error[/bold red] deleting temporary directory: {e}")
 			sys.exit(1)
-
-	def _close_connections(self):
-		if self.ftp:
-			self.ftp.disconnect()
-		if self.sftp:
-			self.sftp.disconnect()
-		if self.ssh:
-			self.ssh.disconnect()
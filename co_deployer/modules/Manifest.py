@@ -0,0 +1,81 @@
+import os
+import json
+import hashlib
+import posixpath
+import threading
+
+class Manifest:
+	"""
+	Tracks the size, modification time and digest of every uploaded file, so
+	unchanged files can be skipped on the next deployment. It is stored as json
+	next to the deployed files.
+	"""
+	FILE_NAME = ".co-deployer-manifest.json"
+	HASH_BLOCK_SIZE = 1 << 20
+
+	def __init__(self, remote_dir, data=None):
+		self.remote_dir = remote_dir
+		self.previous = self._parse(data)
+		self.current = {}
+		self.skipped = 0
+		self._lock = threading.Lock()
+
+	@property
+	def path(self):
+		return posixpath.join(self.remote_dir, self.FILE_NAME)
+
+	def changed(self, local_path, remote_path):
+		"""
+		Records a local file, it is only hashed when its size or modification
+		time differ from the previous deployment
+
+		Returns:
+			bool: True when the file has to be uploaded
+		"""
+		key = self._key(remote_path)
+		st = os.stat(local_path)
+		previous = self.previous.get(key)
+		if previous and previous[:2] == [st.st_size, st.st_mtime_ns]:
+			digest = previous[2]
+		else:
+			digest = self._digest(local_path)
+		with self._lock:
+			self.current[key] = [st.st_size, st.st_mtime_ns, digest]
+			if previous and previous[2] == digest:
+				self.skipped += 1
+				return False
+		return True
+
+	def discard(self, remote_path):
+		"""
+		Forgets a file whose upload failed, so it is retried next time
+		"""
+		with self._lock:
+			self.current.pop(self._key(remote_path), None)
+
+	def dumps(self):
+		return json.dumps(self.current, sort_keys=True).encode("utf-8")
+
+	def _key(self, remote_path):
+		return posixpath.relpath(remote_path, self.remote_dir or ".")
+
+	def _digest(self, local_path):
+		with open(local_path, "rb") as f:
+			# file_digest (python 3.11+) hashes in C without python level reads
+			if hasattr(hashlib, "file_digest"):
+				return hashlib.file_digest(f, "sha256").hexdigest()
+			h = hashlib.sha256()
+			while block := f.read(self.HASH_BLOCK_SIZE):
+				h.update(block)
+			return h.hexdigest()
+
+	def _parse(self, data):
+		# a missing or broken manifest only means everything is uploaded again
+		try:
+			previous = json.loads(data) if data else {}
+		except ValueError:
+			return {}
+		if not isinstance(previous, dict):
+			return {}
+		# entries holding only a digest come from older versions, they are hashed again
+		return {k: v if isinstance(v, list) and len(v) == 3 else [None, None, v] for k, v in previous.items()}
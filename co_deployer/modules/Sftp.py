@@ -1,70 +1,164 @@
 import os
-import sys
-import paramiko
+import stat
+import posixpath
+import socket
+from concurrent.futures import ThreadPoolExecutor
 from rich import print
 
-class Sftp:
-	config = None
-	sftp = None
+if __package__ is None or __package__ == '':
+	# uses current directory visibility
+	from modules.Uploader import Uploader
+else:
+	# uses current package visibility
+	from .Uploader import Uploader
 
-	def __init__(self, config):
-		self.config = config
-		self._connect()
+class Sftp(Uploader):
+	NAME = "SFTP"
+	# aead ciphers encrypt and authenticate each packet in a single openssl call,
+	# instead of a cipher call followed by a separate hmac
+	PREFERRED_CIPHERS = ("aes128-gcm@openssh.com", "aes256-gcm@openssh.com")
+	# local read size, paramiko splits it into protocol sized write requests
+	CHUNK_SIZE = 1 << 20
+	# files from this size are split in ranges written over several clients at once
+	LARGE_FILE_SIZE = 64 * 1024 * 1024
+
+	def __init__(self, config, pool_size=None):
+		self._transports = []
+		super().__init__(config, pool_size)
 
 	def __del__(self):
-		if self.sftp: self.disconnect()
+		if self._transports: self.disconnect()
+
 
-	
-	def _connect(self):
+	def _open(self):
 		"""
-		Connects to the SFTP server
+		Opens one more client, on its own transport
 		"""
+		# paramiko pulls in cryptography, only pay for it when a connection is needed
+		import paramiko
+
 		config = self.config
+		transport = paramiko.Transport((config.get("hostname"), config.get("port")))
 		try:
-			transport = paramiko.Transport((config.get("hostname"), config.get("port")))
+			self._prefer_ciphers(transport)
 			transport.connect(username=config.get("username"), password=config.get("password"))
-			sftp = transport.open_sftp_client()
-			self.sftp = sftp
-		except Exception as e:
-			print("[bold red]SFTP Error[/bold red] :", e)
-			self.sftp = None
-			sys.exit(1)
-	
+			# do not let small trailing write packets wait on Nagle
+			transport.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+			client = transport.open_sftp_client()
+		except Exception:
+			transport.close()
+			raise
+		self._transports.append(transport)
+		return client
+
+	def _prefer_ciphers(self, transport):
+		"""
+		Moves the preferred ciphers the installed paramiko supports first, the
+		server picks the first one it also supports
+		"""
+		options = transport.get_security_options()
+		preferred = tuple(c for c in self.PREFERRED_CIPHERS if c in options.ciphers)
+		options.ciphers = preferred + tuple(c for c in options.ciphers if c not in preferred)
+
 	def disconnect(self):
 		"""
-		Disconnects from the FTP server
+		Disconnects from the SFTP server
 		"""
-		if self.sftp:
-			self.sftp.close()
-			self.sftp = None
-	
-	def upload(self, local_dir, remote_dir):
-		if remote_dir and not self.remote_dir_exists(remote_dir):
-			self.sftp.mkdir(remote_dir)
-			
-		for item in os.listdir(local_dir):
-			local_path = os.path.join(local_dir, item)
-			remote_path = os.path.join(remote_dir, item)
-			remote_path = remote_path.replace("\\", "/")
-			if os.path.isfile(local_path):
-				name = os.path.basename(local_path)
-				try:
-					self.sftp.put(local_path, remote_path)
-					print(f"[bold cyan][SFTP][/bold cyan] [bold green]Uploaded[/bold green] : {name}")
-				except Exception as e:
-					print(f"[bold cyan][SFTP][/bold cyan] [bold red]Error[/bold red] uploading file {name}: {e}")
-			elif os.path.isdir(local_path):
-				name = os.path.basename(local_path)
-				try:
-					self.sftp.mkdir(remote_path)
-					print(f"[bold cyan][SFTP][/bold cyan] [bold green]Created folder[/bold green] : {name}")
-				except Exception as e:
-					print(f"[bold cyan][SFTP][/bold cyan] [bold red]Error[/bold red] creating folder {remote_path}: {e}")
-				self.upload(local_path, remote_path)
-				
-	def remote_dir_exists(self, remote_dir):
+		while not self._pool.empty():
+			self._pool.get_nowait().close()
+		for transport in self._transports:
+			transport.close()
+		self._transports = []
+
+	@property
+	def transport(self):
+		"""
+		The first pooled transport, can be shared to run ssh commands on the same host
+		"""
+		return self._transports[0] if self._transports else None
+
+	def _read(self, remote_path):
+		with self._acquire() as sftp:
+			try:
+				with sftp.open(remote_path, "rb") as f:
+					return f.read()
+			except IOError:
+				return None
+
+	def _write(self, remote_path, data):
+		with self._acquire() as sftp:
+			try:
+				with sftp.open(remote_path, "wb") as f:
+					f.write(data)
+			except IOError as e:
+				print(f"[bold cyan][SFTP][/bold cyan] [bold red]Error[/bold red] writing file {remote_path}: {e}")
+
+	def _put(self, sftp, local_path, remote_path):
+		size = os.path.getsize(local_path)
+		if size >= self.LARGE_FILE_SIZE:
+			self._put_ranges(sftp, local_path, remote_path, size)
+		else:
+			self._put_range(sftp, local_path, remote_path, 0, size, "wb")
+
+	def _mkdir(self, sftp, remote_path):
+		sftp.mkdir(remote_path)
+
+	def _list_dirs(self, sftp, remote_dir):
 		try:
-			self.sftp.stat(remote_dir)
-			return True
+			entries = sftp.listdir_attr(remote_dir)
 		except IOError:
-			return False
+			return set()
+		names = set()
+		for a in entries:
+			mode = a.st_mode or 0
+			# listings do not follow links, a link counts when it points to a folder
+			if stat.S_ISLNK(mode):
+				try:
+					mode = sftp.stat(posixpath.join(remote_dir, a.filename)).st_mode or 0
+				except IOError:
+					continue
+			if stat.S_ISDIR(mode):
+				names.add(a.filename)
+		return names
+
+	def _put_range(self, sftp, local_path, remote_path, offset, length, mode="r+b"):
+		"""
+		Writes length bytes of a local file, from offset, at the same offset of the remote file
+		"""
+		# pipelined writes keep many requests in flight instead of waiting for each ack,
+		# and skipping put's final stat saves a round-trip per file
+		with open(local_path, "rb") as src, sftp.open(remote_path, mode) as dst:
+			src.seek(offset)
+			dst.seek(offset)
+			dst.set_pipelined(True)
+			while length > 0:
+				block = src.read(min(self.CHUNK_SIZE, length))
+				if not block:
+					break
+				dst.write(block)
+				length -= len(block)
+
+	def _put_ranges(self, sftp, local_path, remote_path, size):
+		"""
+		Uploads a large file as contiguous ranges written in parallel, one per client.
+		Only idle or newly opened clients are borrowed, so a worker never waits on
+		another one for them
+		"""
+		clients = [sftp]
+		while len(clients) < self.pool_size:
+			client = self._get(block=False)
+			if client is None:
+				break
+			clients.append(client)
+		try:
+			# truncate or create the remote file, the ranges are then written in place
+			sftp.open(remote_path, "wb").close()
+			length = -(-size // len(clients))
+			offsets = range(0, size, length)
+			with ThreadPoolExecutor(max_workers=len(clients)) as ex:
+				futures = [ex.submit(self._put_range, c, local_path, remote_path, o, length) for c, o in zip(clients, offsets)]
+				for future in futures:
+					future.result()
+		finally:
+			for client in clients[1:]:
+				self._release(client)
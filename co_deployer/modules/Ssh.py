@@ -1,14 +1,34 @@
 import sys
-import paramiko
+import shlex
+import posixpath
 from rich import print
 
+if __package__ is None or __package__ == '':
+	# uses current directory visibility
+	from modules.Uploader import walk
+else:
+	# uses current package visibility
+	from .Uploader import walk
+
+def join_subshells(cmds):
+	"""
+	Joins commands into one posix shell script, each in its own subshell so a cd,
+	an export or a trailing comment stays local to its command, and a failing
+	command does not stop the next ones
+	"""
+	return "\n".join("(\n" + c + "\n)" for c in cmds)
+
 class Ssh:
 	config = None
 	ssh = None
+	transport = None
 
-	def __init__(self, config):
+	def __init__(self, config, transport=None):
 		self.config = config
-		self._connect()
+		# an already authenticated transport to the same host can be shared, it stays owned by its creator
+		self.transport = transport
+		if not transport:
+			self._connect()
 
 	def __del__(self):
 		if self.ssh: self.disconnect()
@@ -18,6 +38,9 @@ class Ssh:
 		"""
 		Connects to the ssh server
 		"""
+		# paramiko pulls in cryptography, only pay for it when a connection is needed
+		import paramiko
+
 		config = self.config
 		try:
 			ssh = paramiko.SSHClient()
@@ -33,8 +56,10 @@ class Ssh:
 		"""
 		Disconnects from the SSH server
 		"""
-		self.ssh.close()
-		self.ssh = None
+		if self.ssh:
+			self.ssh.close()
+			self.ssh = None
+		self.transport = None
 	
 	def execute(self, cmd):
 		"""
@@ -45,5 +70,87 @@ class Ssh:
 
 		Returns: the output of the command
 		"""
-		stdin, stdout, stderr = self.ssh.exec_command(cmd)
-		return stdout.read().decode("utf-8")
\ No newline at end of file
+		if self.ssh:
+			stdin, stdout, stderr = self.ssh.exec_command(cmd)
+			return stdout.read().decode("utf-8")
+
+		channel = self.transport.open_session()
+		try:
+			channel.exec_command(cmd)
+			return channel.makefile("rb").read().decode("utf-8")
+		finally:
+			channel.close()
+
+	def upload_tar(self, local_dir, remote_dir, ignore=None):
+		"""
+		Uploads a local directory as a single compressed tar stream, extracted by
+		tar on the server, instead of one transfer per file. It is compressed with
+		zstd when the zstandard package is installed and the server has zstd, with
+		gzip otherwise
+
+		Parameters:
+			ignore (callable): optional copytree style filter, see Uploader.walk
+
+		Returns:
+			bool: False when the server could not extract the stream
+		"""
+		# only streamed deployments need these, they are not loaded on every run
+		import gzip
+		import tarfile
+		try:
+			import zstandard
+		except ImportError:
+			zstandard = None
+
+		tools = {posixpath.basename(t) for t in self.execute("command -v tar; command -v zstd").split()}
+		if "tar" not in tools:
+			print("[bold cyan][SSH][/bold cyan] [bold red]tar not found on the server[/bold red]")
+			return False
+		use_zstd = zstandard is not None and "zstd" in tools
+		remote = shlex.quote(remote_dir)
+		extract = f"zstd -dc | tar -xf - -C {remote}" if use_zstd else f"tar -xzf - -C {remote}"
+
+		channel = self.ssh.get_transport().open_session() if self.ssh else self.transport.open_session()
+		try:
+			channel.exec_command(f"mkdir -p {remote} && {extract}")
+			raw = channel.makefile("wb")
+			# a fast level, compressing must not become slower than the link
+			if use_zstd:
+				compressor = zstandard.ZstdCompressor(level=3).stream_writer(raw, closefd=False)
+			else:
+				compressor = gzip.GzipFile(fileobj=raw, mode="wb", compresslevel=3)
+			# symlinks are followed, like the per file uploads do
+			with compressor, tarfile.open(fileobj=compressor, mode="w|", dereference=True) as tar:
+				for local_root, arc_root, files in walk(local_dir, "", ignore, self._walk_error):
+					if arc_root:
+						tar.add(local_root, arc_root, recursive=False)
+					for path, arcname in files:
+						tar.add(path, arcname)
+			raw.flush()
+			channel.shutdown_write()
+			status = channel.recv_exit_status()
+			error = channel.makefile_stderr("rb").read().decode("utf-8")
+		except Exception as e:
+			print("[bold cyan][SSH][/bold cyan] [bold red]Error[/bold red] streaming files :", e)
+			return False
+		finally:
+			channel.close()
+
+		if status:
+			print("[bold cyan][SSH][/bold cyan] [bold red]Error[/bold red] extracting files :", error)
+			return False
+		return True
+
+	def _walk_error(self, e):
+		print(f"[bold cyan][SSH][/bold cyan] [bold red]Error[/bold red] reading folder {e.filename}: {e.strerror}")
+
+	def exec_batch(self, cmds):
+		"""
+		Executes several commands over a single SSH channel
+
+		Parameters:
+			cmds (list): the commands to execute, each in its own subshell
+
+		Returns: the output of the commands
+		"""
+		return self.execute(join_subshells(cmds))
@@ -0,0 +1,248 @@
+import os
+import sys
+import errno
+import queue
+import threading
+import posixpath
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+from rich import print
+
+if __package__ is None or __package__ == '':
+	# uses current directory visibility
+	from modules.Manifest import Manifest
+else:
+	# uses current package visibility
+	from .Manifest import Manifest
+
+def walk(local_dir, remote_dir, ignore=None, onerror=None):
+	"""
+	Walks the local tree with os.scandir, the entry types come from the
+	directory read itself so no extra stat is needed per entry. Links are
+	followed, they are uploaded as what they point to, a link back to one of
+	its own parent folders (a loop) is reported and skipped
+
+	Parameters:
+		ignore (callable): optional copytree style filter, called with a folder
+			and its entry names, returning the names to skip
+		onerror (callable): called with the OSError of a folder that can not be
+			walked, the folder is skipped
+
+	Yields:
+		tuple: each (local, remote) folder with its (local, remote) files list, parents first
+	"""
+	stack = [(local_dir, remote_dir, frozenset())]
+	while stack:
+		local_root, remote_root, parents = stack.pop()
+		try:
+			st = os.stat(local_root)
+			folder = (st.st_dev, st.st_ino)
+			if folder in parents:
+				raise OSError(errno.ELOOP, "link to one of its parent folders", local_root)
+			parents = parents | {folder}
+			with os.scandir(local_root) as it:
+				entries = list(it)
+		except OSError as e:
+			if onerror:
+				onerror(e)
+			continue
+		ignored = set(ignore(local_root, [e.name for e in entries])) if ignore else ()
+		files = []
+		for entry in entries:
+			if entry.name in ignored:
+				continue
+			remote_path = posixpath.join(remote_root, entry.name)
+			if entry.is_file():
+				files.append((entry.path, remote_path))
+			elif entry.is_dir():
+				stack.append((entry.path, remote_path, parents))
+		yield local_root, remote_root, files
+
+class Uploader:
+	"""
+	Base of the uploaders, it holds a pool of connections that upload the files
+	in parallel and creates every remote folder once. The protocols provide the
+	connections and the file transfers
+	"""
+	# shown in the messages
+	NAME = None
+	DEFAULT_POOL_SIZE = 4
+	# upper bound of parallel connections, servers often limit them per user
+	MAX_POOL_SIZE = 8
+	config = None
+	pool_size = None
+
+	def __init__(self, config, pool_size=None):
+		self.config = config
+		pool_size = pool_size or config.get("connections") or self.DEFAULT_POOL_SIZE
+		self.pool_size = max(1, min(pool_size, self.MAX_POOL_SIZE))
+		self._pool = queue.Queue()
+		self._opened = 0
+		self._lock = threading.Lock()
+		self._known_remote_dirs = set()
+		self._created_remote_dirs = set()
+		self._listings = {}
+		self._connect()
+
+	@contextmanager
+	def _acquire(self):
+		"""
+		Borrows a connection from the pool and gives it back once done
+		"""
+		conn = self._get()
+		try:
+			yield conn
+		finally:
+			self._release(conn)
+
+	def _release(self, conn):
+		self._pool.put(conn)
+
+	def _get(self, block=True):
+		"""
+		Returns an idle connection, opens a new one while the pool is not full
+		and otherwise waits for one, so a small upload pays a single handshake
+
+		Parameters:
+			block (bool): return None instead of waiting when none is available
+		"""
+		try:
+			return self._pool.get_nowait()
+		except queue.Empty:
+			pass
+		with self._lock:
+			grow = self._opened < self.pool_size
+			if grow:
+				self._opened += 1
+		if grow:
+			try:
+				return self._open()
+			except Exception as e:
+				# servers often limit the connections per user or ip, keep the ones we got
+				with self._lock:
+					self._opened -= 1
+					self.pool_size = self._opened
+				print(f"[bold cyan][{self.NAME}][/bold cyan] using {self._opened} connections :", e)
+		return self._pool.get() if block else None
+
+	def upload(self, local_dir, remote_dir, ignore=None, incremental=False):
+		"""
+		Uploads a local directory to the server
+
+		Parameters:
+			ignore (callable): optional copytree style filter, see walk
+			incremental (bool): only upload the files that changed since the
+				last incremental upload, according to the remote manifest
+		"""
+		manifest = Manifest(remote_dir, self._read(posixpath.join(remote_dir, Manifest.FILE_NAME))) if incremental else None
+
+		# the puts start as soon as their folder is walked and created, the walk
+		# goes parents first so a folder always exists before its content
+		with ThreadPoolExecutor(max_workers=self.pool_size) as ex:
+			futures = []
+			for _, remote_root, files in walk(local_dir, remote_dir, ignore, self._walk_error):
+				if remote_root:
+					with self._acquire() as conn:
+						self._ensure_dir(remote_root, conn)
+				futures.extend(ex.submit(self._put_one, f, manifest) for f in files)
+			for future in futures:
+				future.result()
+
+		if manifest:
+			self._write(manifest.path, manifest.dumps())
+			print(f"[bold cyan][{self.NAME}][/bold cyan] {manifest.skipped} unchanged files skipped")
+
+	def _walk_error(self, e):
+		print(f"[bold cyan][{self.NAME}][/bold cyan] [bold red]Error[/bold red] reading folder {e.filename}: {e.strerror}")
+
+	def _put_one(self, item, manifest=None):
+		local_path, remote_path = item
+		name = os.path.basename(local_path)
+		try:
+			# hashing reads the file too, it may be gone or unreadable since the walk
+			if manifest and not manifest.changed(local_path, remote_path):
+				return
+			with self._acquire() as conn:
+				self._put(conn, local_path, remote_path)
+			print(f"[bold cyan][{self.NAME}][/bold cyan] [bold green]Uploaded[/bold green] : {name}")
+		except Exception as e:
+			print(f"[bold cyan][{self.NAME}][/bold cyan] [bold red]Error[/bold red] uploading file {name}: {e}")
+			if manifest:
+				manifest.discard(remote_path)
+
+	def _ensure_dir(self, remote_path, conn):
+		"""
+		Creates a remote folder unless it is already known to exist
+		"""
+		if remote_path in self._known_remote_dirs:
+			return
+		if not self._remote_dir_listed(remote_path, conn):
+			name = posixpath.basename(remote_path)
+			try:
+				self._mkdir(conn, remote_path)
+				self._created_remote_dirs.add(remote_path)
+				print(f"[bold cyan][{self.NAME}][/bold cyan] [bold green]Created folder[/bold green] : {name}")
+			except Exception as e:
+				print(f"[bold cyan][{self.NAME}][/bold cyan] [bold red]Error[/bold red] creating folder {remote_path}: {e}")
+				return
+		self._known_remote_dirs.add(remote_path)
+
+	def _remote_dir_listed(self, remote_dir, conn):
+		"""
+		Checks a remote folder against the cached listing of its parent,
+		so every parent is listed at most once
+		"""
+		parent, name = posixpath.split(remote_dir.rstrip("/"))
+		if not name:
+			return True
+		# nothing can exist yet in a folder created during this session
+		if parent in self._created_remote_dirs:
+			return False
+		if parent not in self._listings:
+			self._listings[parent] = self._list_dirs(conn, parent or ".")
+		return name in self._listings[parent]
+
+	def _connect(self):
+		"""
+		Opens the first connection, the others are opened when the uploads need them
+		"""
+		try:
+			self._pool.put(self._open())
+			self._opened = 1
+		except Exception as e:
+			print(f"[bold cyan][{self.NAME}][/bold cyan] [bold red]Error[/bold red] :", e)
+			self.disconnect()
+			sys.exit(1)
+
+	def _open(self):
+		"""
+		Returns: a new logged in connection
+		"""
+		raise NotImplementedError
+
+	def _put(self, conn, local_path, remote_path):
+		raise NotImplementedError
+
+	def _mkdir(self, conn, remote_path):
+		raise NotImplementedError
+
+	def _list_dirs(self, conn, remote_dir):
+		"""
+		Returns: the names of the folders in a remote directory, empty when it can not be listed
+		"""
+		raise NotImplementedError
+
+	def _read(self, remote_path):
+		"""
+		Reads a small remote file
+
+		Returns:
+			bytes: its content, None when it can not be read
+		"""
+		raise NotImplementedError
+
+	def _write(self, remote_path, data):
+		"""
+		Writes a small remote file
+		"""
+		raise NotImplementedError
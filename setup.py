@@ -18,6 +18,9 @@ setup(
 		"paramiko",
 		"jsonschema"
     ],
+	extras_require={
+		"fast": ["orjson", "zstandard"],
+	},
 	   entry_points={
         "console_scripts": [
             "co-deployer = co_deployer.co_deployer:main",